@@ -1,3 +1,3 @@
-from s3_nexrad_search import S3NEXRADHelper
+from s3_nexrad_search import S3NEXRADHelper, mergeManifests, writeManifest
 
-__all__ = ['S3NEXRADHelper']
+__all__ = ['S3NEXRADHelper', 'mergeManifests', 'writeManifest']
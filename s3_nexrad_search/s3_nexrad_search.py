@@ -1,8 +1,17 @@
 import datetime
+import hashlib
+import heapq
+import httplib
 import math
 import multiprocessing
 import os
+import Queue
+import random
+import re
+import sys
+import threading
 import time
+import traceback
 
 import boto
 import matplotlib
@@ -28,6 +37,9 @@ S3_NEXRAD_START_DATE=datetime.datetime(month=6, year=1991, day=1)
 
 DATASET_START_DATE=DUAL_POLE_DEPLOYMENT_COMPLETION
 
+# Reference time for converting scan times to seconds
+EPOCH=datetime.datetime(month=1, year=1970, day=1)
+
 # beam distance from: https://www.roc.noaa.gov/WSR88D/Engineering/NEXRADTechInfo.aspx
 WSR88D_BEAM_DISTANCE=230
 
@@ -40,6 +52,19 @@ WSR88D_HIGH_ANGLE=math.radians(19.5)
 # Earth radius in km
 EARTH_RADIUS_KM=6371.0
 
+# Volume files in the bucket, older ones are gzipped ex. KIND20150505_150723_V06.gz
+# and current ones are not ex. KIND20261019_000100_V06
+VOLUME_KEY_PATTERN=re.compile(r"_V\d\d(\.gz)?$")
+
+# Rough round trip time in seconds of a single S3 request, used for download estimates
+S3_REQUEST_LATENCY=0.1
+
+# Number of times a download is retried after a failed or corrupted transfer
+DOWNLOAD_RETRIES=3
+
+# Bytes read from S3 at a time while downloading
+DOWNLOAD_CHUNK_SIZE=1024*1024
+
 # Coefficent for the distance of the radius of a radar station that would be relevant
 RELEVANT_DISTANCE_COEFFICENT=0.5
 
@@ -226,8 +251,17 @@ class S3NEXRADHelper:
         self.thread_max = threads
         self.threads = []
         self.thread_count = 0
-
-    def findNEXRADKeysByTimeAndDomain(self, start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height):
+        # station id -> last key seen while following
+        self.last_seen_keys = {}
+        # download workers report (key, file_path, status, retries) here
+        self.result_queue = multiprocessing.Queue()
+        self.download_results = []
+        self.download_report = None
+        # per thread S3 connections for the in-process engine
+        self.thread_local = threading.local()
+
+    def findNEXRADKeysByTimeAndDomain(self, start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height,
+            shard=None):
         """Get list of keys to nexrad files on s3 from a time range and lat/lon domain.
 
         start_datetime: start of time range in a datetime.datetime object
@@ -237,6 +271,8 @@ class S3NEXRADHelper:
         minlat: minimum lattitude of domain
         minlon: minimum longitude of domain
         height: height above sealevel in meters for domain
+        shard: optional tuple of (shard_index, shard_count) to only search this node's
+            share. Shard either the search or downloadNEXRADFiles, not both.
 
         returns: List of keys in nexrad s3 bucket corespopnding to the parameters
         """
@@ -248,7 +284,7 @@ class S3NEXRADHelper:
         if self.verbose:
            print "Found stations: %s for domain %s,%s to %s,%s" % (','.join(station_list),
                    maxlat, maxlon, minlat, minlon)
-        files = self.searchNEXRADS3(start_datetime, end_datetime, station_list)
+        files = self.searchNEXRADS3(start_datetime, end_datetime, station_list, shard=shard)
 
         if self.verbose:
             print "Found files for time range: %s to %s" % (
@@ -259,28 +295,199 @@ class S3NEXRADHelper:
 
         return files
 
-    def downloadNEXRADFiles(self, download_dir, s3keys):
+    def downloadNEXRADFiles(self, download_dir, s3keys, shard=None, time_ordered=False,
+            latest_first=False, slice_minutes=None, slice_callback=None, slice_stations=None,
+            result_callback=None):
         """Download files from S3 NEXRAD bucket
 
         download_dir: The directory to download the file to
         s3keys: list of keys in the nexrad bucket to download
-
-        returns: list of downloaded file paths
+        shard: optional tuple of (shard_index, shard_count) to only download this
+            node's share of s3keys, split by a hash of each key. Only use it when every
+            node has the full key list, s3keys from a sharded search are already this
+            node's share and sharding them again would skip most of them.
+        time_ordered: Boolean of if files should be downloaded in order of scan time
+            across all stations instead of in the order of s3keys, taking turns between
+            stations with scans at the same time. With slice_minutes each time slice
+            starts with one file from every station before the rest of its files.
+        latest_first: Boolean of if time ordered downloads should start with the latest
+            scans and work backwards
+        slice_minutes: length in minutes of the time slices to report on with
+            slice_callback
+        slice_callback: function called as slice_callback(slice_start, file_paths,
+            missing_stations) as soon as every selected station has a downloaded file
+            for a time slice. slice_start is a datetime.datetime object and file_paths
+            are the files downloaded for that slice so far. Files that finish after
+            their slice was reported are not passed to slice_callback again, they are
+            only in the returned list and result_callback. Slices that are still
+            incomplete when the downloads end are reported then, in time order, with
+            the stations that have no file for them in missing_stations. It is an
+            empty list for complete slices.
+        slice_stations: list of the selected station ids that make a slice complete,
+            defaults to the stations in s3keys
+        result_callback: function called as result_callback(key, file_path, status,
+            retries) in this process as each download finishes, status is one of
+            'downloaded', 'failed' or 'missing'
+
+        Each file is checked against the size and single-part ETag (MD5) from S3 while
+        it is streamed to disk and is downloaded again if it does not match. A summary
+        is stored in self.download_report as a dictionary with the keys
+            downloaded: number of files downloaded and verified
+            redownloaded: number of those that needed more than one attempt
+            failed: list of keys that still did not match after all retries
+            missing: list of keys that were not found in the bucket
+
+        returns: list of downloaded and verified file paths
         """
         if not os.path.exists(download_dir):
             print "Unable to find download directory, skipping downloads"
             return
+
+        if shard is not None:
+            shard_index, shard_count = _checkShard(shard)
+            s3keys = _partitionKeys(s3keys, shard_count)[shard_index]
+
+        if time_ordered:
+            s3keys = _scheduleKeysByTime(s3keys, latest_first, slice_minutes)
+
+        result_callbacks = []
+        slice_tracker = None
+        if slice_minutes is not None and slice_callback is not None:
+            slice_tracker = _TimeSliceTracker(s3keys, slice_minutes, slice_callback, slice_stations)
+            result_callbacks.append(slice_tracker.addResult)
+        if result_callback is not None:
+            result_callbacks.append(result_callback)
+
+        def reportResult(*result):
+            for callback in result_callbacks:
+                callback(*result)
+
+        self.download_results = []
         file_paths = []
         for key in s3keys:
             file_path = os.path.join(download_dir, key.split('/')[-1])
             file_paths.append(file_path)
 
-            self._addToThreadPool(_downloadFile, (key, file_path, self.verbose))
-            self._waitForThreadPool()
+            self._addToThreadPool(_downloadFile, (key, file_path, self.verbose, self.result_queue))
+            self._waitForThreadPool(result_callback=reportResult)
+
+        self._waitForThreadPool(thread_max=0, result_callback=reportResult)
+        self._collectResults(result_callback=reportResult)
 
-        self._waitForThreadPool(thread_max=0)
+        # a worker that was killed never reports, count its file as failed
+        reported_keys = set([result[0] for result in self.download_results])
+        for key, file_path in zip(s3keys, file_paths):
+            if key not in reported_keys:
+                print "%s was not downloaded, the download worker exited early" % key
+                self.download_results.append((key, file_path, 'failed', 0))
+                reportResult(key, file_path, 'failed', 0)
+                reported_keys.add(key)
 
-        return file_paths
+        if slice_tracker is not None:
+            slice_tracker.finish()
+
+        self.download_report = self._reportDownloads(self.download_results)
+        verified_paths = set([file_path for key, file_path, status, retries in self.download_results
+                if status == 'downloaded'])
+
+        return [file_path for file_path in file_paths if file_path in verified_paths]
+
+    def downloadAndProcessNEXRADFiles(self, download_dir, s3keys, processor, process_workers=None,
+            max_pending=None, ordered=True, pass_buffer=False, **download_options):
+        """Download files from S3 NEXRAD bucket and run a function on each file as soon as
+        it is downloaded, in its own process, so downloading and processing overlap.
+        An exception in processor, or processor crashing its process, only fails the
+        file it was running on.
+
+        download_dir: The directory to download the file to
+        s3keys: list of keys in the nexrad bucket to download
+        processor: function to run on each file, called as processor(file_path) or
+            processor(file_path, data) with pass_buffer. On platforms without fork it
+            must be defined at the top level of a module.
+        process_workers: number of files to process at once, defaults to the number
+            of cores
+        max_pending: maximum number of downloaded files waiting to be processed before
+            downloading pauses, defaults to twice process_workers
+        ordered: Boolean of if results should be in the order of s3keys instead of the
+            order processing finished
+        pass_buffer: Boolean of if processor should also get the contents of the file
+        download_options: other keyword arguments for downloadNEXRADFiles ex. shard
+
+        returns: list of (file_path, result, error) tuples for each key where error is
+            None, the formatted traceback of the exception from processor, or a message
+            if the download failed or the processing process died
+        """
+        if not os.path.exists(download_dir):
+            print "Unable to find download directory, skipping downloads"
+            return
+
+        if process_workers is None:
+            process_workers = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = process_workers * 2
+
+        process_queue = multiprocessing.Queue()
+        # downloaded file paths waiting for a process
+        waiting = []
+        # file path -> process running processor on it
+        running = {}
+        # (file_path, result, error) in the order processing finished
+        finished = []
+        reported_paths = set()
+
+        def collectProcessed():
+            exited = [file_path for file_path, proc in running.items() if proc.exitcode is not None]
+            # processes can not exit until their results are read off the queue, and
+            # results of exited processes are already on it
+            while True:
+                try:
+                    result = process_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                finished.append(result)
+                reported_paths.add(result[0])
+            for file_path in exited:
+                proc = running.pop(file_path)
+                proc.join()
+                if file_path not in reported_paths:
+                    finished.append((file_path, None,
+                            "Processing process exited with code %s" % proc.exitcode))
+                    reported_paths.add(file_path)
+            while waiting and len(running) < process_workers:
+                file_path = waiting.pop(0)
+                proc = multiprocessing.Process(target=_processFile,
+                        args=(processor, file_path, pass_buffer, process_queue))
+                proc.start()
+                running[file_path] = proc
+
+        def submit(key, file_path, status, retries):
+            if status != 'downloaded':
+                finished.append((file_path, None, "Download %s for %s" % (status, key)))
+                return
+            waiting.append(file_path)
+            collectProcessed()
+            # downloading pauses here until enough waiting files are started
+            while len(waiting) >= max_pending:
+                time.sleep(.1)
+                collectProcessed()
+
+        try:
+            self.downloadNEXRADFiles(download_dir, s3keys, result_callback=submit,
+                    **download_options)
+            while waiting or running:
+                collectProcessed()
+                time.sleep(.1)
+        except:
+            for proc in running.values():
+                proc.terminate()
+            raise
+
+        if ordered:
+            # downloads finish out of order, put results back in the order of s3keys
+            key_order = dict([(os.path.join(download_dir, key.split('/')[-1]), i)
+                    for i, key in enumerate(s3keys)])
+            finished.sort(key=lambda result: key_order.get(result[0], len(key_order)))
+        return finished
 
     def getStationsFromWRFDomain(self, dx, dy, e_sn, e_we, ref_lat, ref_lon, height):
         """Searches station list for radar stations that would be relevant
@@ -295,15 +502,102 @@ class S3NEXRADHelper:
 
         returns: list of station ids ex. ['KIND', 'KLVX']
         """
-        center_east, center_north, zone_number, zone_letter = utm.from_latlon(ref_lat, ref_lon)
-        maxlat, maxlon = utm.to_latlon(center_east + (e_we/2.0*dx), center_north + (e_sn/2.0*dy),
-                                       zone_number, zone_letter, strict=False)
-        minlat, minlon = utm.to_latlon(center_east - (e_we/2.0*dx), center_north - (e_sn/2.0*dy),
-                                       zone_number, zone_letter, strict=False)
+        maxlat, maxlon, minlat, minlon = self._getWRFDomainBounds(dx, dy, e_sn, e_we, ref_lat, ref_lon)
 
         station_list = self.getStationsFromDomain(maxlat, maxlon, minlat, minlon, height)
         return station_list
 
+    def getStationCoverageForWRFDomains(self, wrf_domains, heights, above_ground=True):
+        """Find which radar stations are relevant to each of several WRF domains at each
+        of several heights in one pass, see getStationCoverage.
+
+        wrf_domains: list of (dx, dy, e_sn, e_we, ref_lat, ref_lon) tuples, equivalent to
+            the namelist.wps variables for each domain. For nests, give the dx, dy, e_sn,
+            e_we and center of the nest itself.
+        heights: list of heights in meters
+        above_ground: Boolean of if heights are above the ground at each station instead
+            of above sealevel
+
+        returns: tuple of (station_ids, coverage), see getStationCoverage
+        """
+        domains = [self._getWRFDomainBounds(*wrf_domain) for wrf_domain in wrf_domains]
+        return self.getStationCoverage(domains, heights, above_ground)
+
+    def getStationCoverage(self, domains, heights, above_ground=True):
+        """Find which radar stations are relevant to each of several domains at each of
+        several heights, ex. a vertical profile from 1000 to 20000 meters above ground
+        in 500 meter steps. The radar radius of every station at every height is solved once for all
+        domains and the domain checks are done on whole arrays.
+
+        Stations near a corner of a domain are relevant if they are within the relevant
+        distance of the corner.
+
+        domains: list of (maxlat, maxlon, minlat, minlon) tuples
+        heights: list of heights in meters
+        above_ground: Boolean of if heights are above the ground at each station instead
+            of above sealevel like getStationsFromDomain
+
+        returns: tuple of (station_ids, coverage) where station_ids is the list of all
+            station ids and coverage is a numpy boolean array with the shape
+            (len(domains), len(station_ids), len(heights)) that is True where the
+            station is relevant to the domain at the height
+        """
+        heights = numpy.asarray(heights, dtype=float)
+        station_lats = numpy.array([station['latitude'] for station in STATION_INDEX])
+        station_lons = numpy.array([station['longitude'] for station in STATION_INDEX])
+        station_elevations = numpy.array([station['station_elevation'] for station in STATION_INDEX])
+
+        # stations x heights, NaN where the height is not available
+        relevant_radii = RELEVANT_DISTANCE_COEFFICENT*self._calculateRadiiAtHeights(
+                heights, station_elevations, above_ground)
+        available = ~numpy.isnan(relevant_radii)
+        relevant_radii = numpy.where(available, relevant_radii, 0)
+
+        lats = station_lats[:, numpy.newaxis]
+        lons = station_lons[:, numpy.newaxis]
+
+        coverage = numpy.zeros((len(domains), len(STATION_INDEX), len(heights)), dtype=bool)
+        for d, (maxlat, maxlon, minlat, minlon) in enumerate(domains):
+            maxeast_domain, maxnorth_domain, max_zone_number, max_zone_letter = utm.from_latlon(
+                    maxlat, maxlon)
+            mineast_domain, minnorth_domain, min_zone_number, min_zone_letter = utm.from_latlon(
+                    minlat, minlon)
+
+            domain_maxlat, domain_maxlon = utm.to_latlon(maxeast_domain + relevant_radii,
+                    maxnorth_domain + relevant_radii, max_zone_number, max_zone_letter, strict=False)
+            domain_minlat, domain_minlon = utm.to_latlon(mineast_domain - relevant_radii,
+                    minnorth_domain - relevant_radii, min_zone_number, min_zone_letter, strict=False)
+
+            # Vertical band of relevant domain bounded by user-given domain
+            relevant = (_between(lats, domain_minlat, domain_maxlat) &
+                    (lons <= maxlon) & (lons >= minlon))
+
+            # Horizontal band of relevant domain bounded by user-given domain
+            relevant |= ((lats <= maxlat) & (lats >= minlat) &
+                    _between(lons, domain_minlon, domain_maxlon))
+
+            # corners of relevant domain
+            for corner_lat, corner_lon, in_lat_band, in_lon_band in (
+                    (maxlat, maxlon, _between(lats, maxlat, domain_maxlat),
+                        _between(lons, maxlon, domain_maxlon)),
+                    (minlat, maxlon, _between(lats, domain_minlat, minlat),
+                        _between(lons, maxlon, domain_maxlon)),
+                    (minlat, minlon, _between(lats, domain_minlat, minlat),
+                        _between(lons, domain_minlon, minlon)),
+                    (maxlat, minlon, _between(lats, maxlat, domain_maxlat),
+                        _between(lons, domain_minlon, minlon))):
+                corner_easting, corner_northing, zone_number, zone_letter = utm.from_latlon(
+                        corner_lat, corner_lon)
+                station_eastings, station_northings, station_zone_number, station_zone_letter = utm.from_latlon(
+                        station_lats, station_lons, force_zone_number=zone_number)
+                corner_distances = numpy.hypot(station_eastings - corner_easting,
+                        station_northings - corner_northing)[:, numpy.newaxis]
+                relevant |= in_lat_band & in_lon_band & (corner_distances <= relevant_radii)
+
+            coverage[d] = relevant & available
+
+        return (list(STATION_IDS), coverage)
+
             
     def getStationsFromDomain(self, maxlat, maxlon, minlat, minlon, height):
         """Searches station list for radar stations that would be relevant
@@ -401,28 +695,470 @@ class S3NEXRADHelper:
 
         return relevant_stations
 
-    def searchNEXRADS3(self, start_datetime, end_datetime, station_list):
+    def searchNEXRADS3(self, start_datetime, end_datetime, station_list, shard=None):
         """Find available files from a date range and a station list
 
         start_datetime: start of time range in a datetime.datetime object
         end_datetime: end of time range in a datetime.datetime object
         station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+        shard: optional tuple of (shard_index, shard_count) to only list this node's
+            share of the (day, station) prefixes. shard_index starts at 0. Shard either
+            the search or downloadNEXRADFiles, not both.
 
         returns: list of keys in the nexrad s3 bucket within the time range for the specified stations
         """
+        start, end = self._clampTimeRange(start_datetime, end_datetime)
+
+        dir_key_list = self._buildDirKeyList(start, end, station_list)
+
+        if shard is not None:
+            shard_index, shard_count = _checkShard(shard)
+            dir_key_list = _partitionDirKeys(dir_key_list, shard_count)[shard_index]
+
+        files_list = []
+        for dir_key in dir_key_list:
+            for file in self._listDirKey(dir_key, start, end):
+                files_list.append(file.name)
+        return files_list
+
+    def estimateNEXRADDownload(self, start_datetime, end_datetime, station_list,
+            bandwidth=None, sample_size=None, shard=None):
+        """Estimate the size and cost of downloading files from a date range and a
+        station list without downloading them. Object sizes come from the listing.
+        For huge ranges only a sample of the full day (day, station) prefixes is listed
+        and the totals are scaled up from it. The partial first and last days are always
+        listed exactly.
+
+        start_datetime: start of time range in a datetime.datetime object
+        end_datetime: end of time range in a datetime.datetime object
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+        bandwidth: available bandwidth in bytes per second, used to estimate the time
+        sample_size: maximum number of full day prefixes to list across all stations,
+            in addition to the first and last day of each station, at least 1 or None
+            to list all of them. Stations without a sampled day use the average of the
+            sampled days.
+        shard: optional tuple of (shard_index, shard_count) to only estimate this
+            node's share
+
+        returns: dictionary with the keys
+            total_bytes: projected bytes to download
+            file_count: projected number of files (one GET request each)
+            list_requests: number of list requests a full search would need
+            listed_prefixes: number of prefixes actually listed for this estimate
+            sampled: Boolean of if the totals were scaled up from a sample
+            estimated_seconds: projected download time at self.thread_max threads,
+                None if bandwidth is not given
+            stations: dictionary of station id to dictionary of total_bytes,
+                file_count and prefixes for that station, and extrapolated, a Boolean
+                of if its full days were projected from the other stations' samples
+                because none of its own were sampled
+        """
+        if sample_size is not None and sample_size < 1:
+            raise ValueError("sample_size must be at least 1, got %r" % (sample_size,))
+
+        start, end = self._clampTimeRange(start_datetime, end_datetime)
+
+        dir_key_list = self._buildDirKeyList(start, end, station_list)
+
+        if shard is not None:
+            shard_index, shard_count = _checkShard(shard)
+            dir_key_list = _partitionDirKeys(dir_key_list, shard_count)[shard_index]
+
+        # the first and last days are partial so they are always listed exactly, only
+        # the full days in between are sampled
+        edge_days = (start.strftime("%Y/%m/%d"), end.strftime("%Y/%m/%d"))
+        edge_dir_keys = [dir_key for dir_key in dir_key_list if dir_key[:10] in edge_days]
+        full_dir_keys = [dir_key for dir_key in dir_key_list if dir_key[:10] not in edge_days]
+
+        sampled = sample_size is not None and len(full_dir_keys) > sample_size
+        sample_dir_keys = full_dir_keys
+        if sampled:
+            # seeded so repeated estimates of the same range agree
+            sample_dir_keys = random.Random(0).sample(sorted(full_dir_keys), sample_size)
+
+        # 2015/05/06/KSGF -> (bytes, files)
+        listed = {}
+        for dir_key in edge_dir_keys + sample_dir_keys:
+            files = self._listDirKey(dir_key, start, end)
+            listed[dir_key] = (sum([file.size for file in files]), len(files))
+
+        # stations without a sampled full day use the average full day of all stations
+        sample_count = max(1, len(sample_dir_keys))
+        average_bytes = float(sum([listed[dir_key][0] for dir_key in sample_dir_keys])) / sample_count
+        average_files = float(sum([listed[dir_key][1] for dir_key in sample_dir_keys])) / sample_count
+
+        stations = {}
+        for station_id in sorted(set([dir_key[11:] for dir_key in dir_key_list])):
+            station_edges = [dir_key for dir_key in edge_dir_keys if dir_key[11:] == station_id]
+            station_full = [dir_key for dir_key in full_dir_keys if dir_key[11:] == station_id]
+            station_samples = [dir_key for dir_key in sample_dir_keys if dir_key[11:] == station_id]
+
+            station_bytes = sum([listed[dir_key][0] for dir_key in station_edges])
+            station_files = sum([listed[dir_key][1] for dir_key in station_edges])
+            if station_samples:
+                station_bytes += (float(sum([listed[dir_key][0] for dir_key in station_samples])) /
+                        len(station_samples) * len(station_full))
+                station_files += (float(sum([listed[dir_key][1] for dir_key in station_samples])) /
+                        len(station_samples) * len(station_full))
+            else:
+                station_bytes += average_bytes * len(station_full)
+                station_files += average_files * len(station_full)
+
+            stations[station_id] = {
+                    'total_bytes': int(round(station_bytes)),
+                    'file_count': int(round(station_files)),
+                    'prefixes': len(station_edges) + len(station_full),
+                    'extrapolated': bool(station_full) and not station_samples}
+
+        total_bytes = sum([station['total_bytes'] for station in stations.values()])
+        file_count = sum([station['file_count'] for station in stations.values()])
+
+        estimated_seconds = None
+        if bandwidth:
+            # transfer is bound by the bandwidth, per request latency is spread over the threads
+            estimated_seconds = (float(total_bytes) / bandwidth +
+                    file_count * S3_REQUEST_LATENCY / max(1, self.thread_max))
+
+        return {'total_bytes': total_bytes,
+                'file_count': file_count,
+                'list_requests': len(dir_key_list),
+                'listed_prefixes': len(listed),
+                'sampled': sampled,
+                'estimated_seconds': estimated_seconds,
+                'stations': stations}
+
+    def iterNEXRADS3(self, start_datetime, end_datetime, station_list, list_threads=None,
+            shard=None):
+        """Find available files from a date range and a station list, listing the
+        (day, station) prefixes concurrently in this process and yielding keys as
+        each prefix finishes. Keys are not in any particular order.
+
+        start_datetime: start of time range in a datetime.datetime object
+        end_datetime: end of time range in a datetime.datetime object
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+        list_threads: number of prefixes to list at once, defaults to threads
+        shard: optional tuple of (shard_index, shard_count) to only list this node's
+            share. Shard either the search or the download, not both.
+
+        returns: generator of keys in the nexrad s3 bucket within the time range
+        """
+        start, end = self._clampTimeRange(start_datetime, end_datetime)
+
+        dir_key_list = self._buildDirKeyList(start, end, station_list)
+
+        if shard is not None:
+            shard_index, shard_count = _checkShard(shard)
+            dir_key_list = _partitionDirKeys(dir_key_list, shard_count)[shard_index]
+
+        if list_threads is None:
+            list_threads = self.thread_max
+
+        def listDirKey(dir_key):
+            return [file.name for file in self._listDirKey(dir_key, start, end, self._threadBucket())]
+
+        for files in self._iterThreaded(listDirKey, dir_key_list, list_threads):
+            for file_name in files:
+                yield file_name
+
+    def iterDownloadNEXRADFiles(self, download_dir, s3keys, download_threads=None):
+        """Download files from S3 NEXRAD bucket with threads in this process instead of
+        worker processes, reusing one S3 connection per thread. The header check and
+        download of each key run in the same stage and are verified as in
+        downloadNEXRADFiles. s3keys may be a generator such as iterNEXRADS3 so downloads
+        start while listing is still running.
+
+        download_dir: The directory to download the file to
+        s3keys: iterable of keys in the nexrad bucket to download
+        download_threads: number of files to download at once, defaults to threads
+
+        returns: generator of (key, file_path, status, retries) tuples in the order
+            the downloads finish, status is one of 'downloaded', 'failed' or 'missing'
+        """
+        if not os.path.exists(download_dir):
+            print "Unable to find download directory, skipping downloads"
+            return
+
+        if download_threads is None:
+            download_threads = self.thread_max
+
+        def downloadKey(key):
+            file_path = os.path.join(download_dir, key.split('/')[-1])
+            try:
+                return _downloadKey(self._threadBucket(), key, file_path, self.verbose)
+            except Exception:
+                print "Unable to download %s\n%s" % (key, traceback.format_exc().rstrip())
+                return (key, file_path, 'failed', 0)
+
+        for result in self._iterThreaded(downloadKey, s3keys, download_threads):
+            yield result
+
+    def _threadBucket(self):
+        """Get the S3 bucket for the current thread, connecting on first use so each
+        thread keeps its own connection alive between requests
+
+        returns: boto bucket object
+        """
+        if not hasattr(self.thread_local, 'bucket'):
+            s3conn = boto.connect_s3(anon=True)
+            self.thread_local.bucket = s3conn.get_bucket("noaa-nexrad-level2")
+        return self.thread_local.bucket
+
+    def _iterThreaded(self, function, items, thread_count):
+        """Run a function over items in a bounded number of threads, yielding results
+        as they finish. Items are read lazily and at most twice thread_count are
+        queued at a time, so items may be a generator. An exception in function or
+        while reading items is raised here. Closing the generator stops reading items
+        and skips the items that have not started yet.
+
+        function: function that takes one item
+        items: iterable of items
+        thread_count: number of threads to run
+
+        returns: generator of function results
+        """
+        thread_count = max(1, thread_count)
+        tasks = Queue.Queue(maxsize=thread_count * 2)
+        results = Queue.Queue()
+        done = object()
+        stopped = threading.Event()
+
+        def worker():
+            while True:
+                item = tasks.get()
+                if item is done:
+                    results.put((done, None))
+                    return
+                # keep taking items after a stop so the feeder is not blocked
+                if stopped.is_set():
+                    continue
+                try:
+                    results.put((True, function(item)))
+                except Exception:
+                    results.put((False, sys.exc_info()))
+
+        def feeder():
+            try:
+                for item in items:
+                    if stopped.is_set():
+                        break
+                    tasks.put(item)
+            except Exception:
+                results.put((False, sys.exc_info()))
+            finally:
+                # stop an earlier stage feeding items, ex. iterNEXRADS3
+                if stopped.is_set() and hasattr(items, 'close'):
+                    items.close()
+                for i in range(thread_count):
+                    tasks.put(done)
+
+        threads = [threading.Thread(target=feeder)]
+        threads.extend([threading.Thread(target=worker) for i in range(thread_count)])
+        for thread in threads:
+            # do not keep the interpreter alive if the caller stops iterating
+            thread.daemon = True
+            thread.start()
+
+        finished = 0
+        try:
+            while finished < thread_count:
+                # a get without a timeout can not be interrupted by Ctrl-C in python 2
+                try:
+                    success, result = results.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if success is done:
+                    finished += 1
+                elif success:
+                    yield result
+                else:
+                    raise result[0], result[1], result[2]
+        finally:
+            stopped.set()
+
+    def _listDirKey(self, dir_key, start, end, bucket=None):
+        """List the files in one (day, station) prefix that fall within a time range
+
+        dir_key: prefix ex. "2015/05/06/KSGF"
+        start: start of time range in a datetime.datetime object
+        end: end of time range in a datetime.datetime object
+        bucket: boto bucket object to list with, defaults to self.bucket
+
+        returns: list of boto key objects
+        """
+        if bucket is None:
+            bucket = self.bucket
+
+        start_dir = "%d/%02d/%02d/" % (start.year, start.month ,start.day)
+        end_dir = "%d/%02d/%02d/" % (end.year, end.month, end.day)
+        files_list = []
+
+        # 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+        # drop everything except the time the time
+        before_time_index = 20
+        after_time_index = 35
+        for file in bucket.list("%s/" % dir_key, "/"):
+            file_name = file.name 
+
+            # skip _MDM and other sidecar files
+            if not VOLUME_KEY_PATTERN.search(file_name):
+                continue
+
+            if file_name.startswith(start_dir):
+                file_datetime = datetime.datetime.strptime(
+                        file_name[before_time_index:after_time_index],
+                        "%Y%m%d_%H%M%S")
+                if file_datetime <= start:
+                    continue
+
+            if file_name.startswith(end_dir):
+                file_datetime = datetime.datetime.strptime(
+                        file_name[before_time_index:after_time_index],
+                        "%Y%m%d_%H%M%S")
+                if file_datetime >= end:
+                    continue
+
+            files_list.append(file)
+        return files_list
+
+    def followNEXRADS3(self, station_list, download_dir=None, start_datetime=None,
+            poll_interval=60, poll_jitter=5, max_polls=None):
+        """Poll the bucket for new files from a station list as they arrive. Only keys
+        after the last seen key for each station are listed, so the cost of a poll
+        depends only on the amount of new data.
+
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+        download_dir: optional directory to download new files to as they are found.
+            Finished downloads are reported after each poll and the report is stored
+            in self.download_report, see downloadNEXRADFiles
+        start_datetime: only follow files after this time in a datetime.datetime object
+            in UTC, defaults to now. Ignored for stations already in self.last_seen_keys
+        poll_interval: seconds to wait between polls
+        poll_jitter: maximum random seconds added to each wait so many followers
+            do not poll in lockstep
+        max_polls: stop after this many polls, None to poll forever
+
+        returns: generator of lists of new keys, one list per poll
+        """
+        if download_dir is not None and not os.path.exists(download_dir):
+            print "Unable to find download directory, skipping downloads"
+            download_dir = None
+
+        if start_datetime is None:
+            start_datetime = datetime.datetime.utcnow()
+
+        for station_id in station_list:
+            if station_id not in STATION_IDS:
+                print "Station %s not found, skipping" % station_id
+                continue
+            if station_id not in self.last_seen_keys:
+                # keys sort by time so a partial key works as the first marker
+                self.last_seen_keys[station_id] = "%s/%s%s" % (
+                        _dirKeyForDay(start_datetime, station_id), station_id,
+                        start_datetime.strftime("%Y%m%d_%H%M%S"))
+
+        self.download_results = []
+        poll_count = 0
+        try:
+            while max_polls is None or poll_count < max_polls:
+                if poll_count > 0:
+                    time.sleep(poll_interval + random.uniform(0, poll_jitter))
+                poll_count += 1
+
+                new_keys = []
+                for station_id in station_list:
+                    if station_id in self.last_seen_keys:
+                        new_keys.extend(self._pollStation(station_id))
+
+                if download_dir is not None:
+                    for key in new_keys:
+                        file_path = os.path.join(download_dir, key.split('/')[-1])
+                        self._addToThreadPool(_downloadFile,
+                                (key, file_path, self.verbose, self.result_queue))
+                        self._waitForThreadPool()
+                    self._reportFollowedDownloads()
+
+                yield new_keys
+        finally:
+            if download_dir is not None:
+                self._waitForThreadPool(thread_max=0)
+                self._reportFollowedDownloads()
+
+    def _reportFollowedDownloads(self):
+        """Report the downloads that finished since the last poll and clear them so a
+        long running follow does not keep every result, the report of the last poll
+        is stored in self.download_report
+        """
+        self._collectResults()
+        if self.download_results:
+            self.download_report = self._reportDownloads(self.download_results)
+            self.download_results = []
+
+    def _pollStation(self, station_id):
+        """List keys for a station after its last seen key, moving on to following days
+        up to the current day, and advance the last seen key.
+
+        station_id: station id as a string ex. "KIND"
+
+        returns: list of new keys in the nexrad s3 bucket
+        """
+        marker = self.last_seen_keys[station_id]
+        marker_day = datetime.datetime.strptime(marker[:10], "%Y/%m/%d")
+        today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        new_keys = []
+        current_day = marker_day
+        while current_day <= today:
+            dir_key = _dirKeyForDay(current_day, station_id)
+            for file in self.bucket.list("%s/" % dir_key, "/", marker=marker):
+                file_name = file.name
+                marker = file_name
+
+                # skip _MDM and other sidecar files
+                if not VOLUME_KEY_PATTERN.search(file_name):
+                    continue
+
+                new_keys.append(file_name)
+            current_day = current_day + datetime.timedelta(days=1)
+
+        # earlier days have been listed, so later polls can start at today's prefix
+        marker = max(marker, "%s/" % _dirKeyForDay(today, station_id))
+
+        if marker > self.last_seen_keys[station_id]:
+            self.last_seen_keys[station_id] = marker
+
+        return new_keys
+
+    def _clampTimeRange(self, start_datetime, end_datetime):
+        """Clamp a time range to the times available in the dataset
+
+        start_datetime: start of time range in a datetime.datetime object
+        end_datetime: end of time range in a datetime.datetime object
+
+        returns: tuple of (start, end) datetime.datetime objects
+        """
         start = start_datetime
         if start_datetime < DATASET_START_DATE:
-            if verbose:
+            if self.verbose:
                 print "Start time is before the dataset start date, will use dataset start time instead"
             start = DATASET_START_DATE
 
         end = end_datetime
         if end_datetime > datetime.datetime.now():
-            if verbose:
+            if self.verbose:
                 print "End time is in the future, will use today as end time"
             end = datetime.datetime.now()
 
+        return (start, end)
+
+    def _buildDirKeyList(self, start, end, station_list):
+        """Build the list of (day, station) prefixes in the bucket for a time range
 
+        start: start of time range in a datetime.datetime object
+        end: end of time range in a datetime.datetime object
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+
+        returns: list of prefixes ex. ["2015/05/06/KSGF"]
+        """
         dir_key_list = []
         for station_id in station_list:
             if station_id not in STATION_IDS:
@@ -430,41 +1166,9 @@ class S3NEXRADHelper:
                 continue
             current_date = start.replace(hour=0)
             while current_date < end:
-                dir_key_list.append("%d/%02d/%02d/%s" % (current_date.year, current_date.month,
-                    current_date.day, station_id))
+                dir_key_list.append(_dirKeyForDay(current_date, station_id))
                 current_date = current_date + datetime.timedelta(days=1)
-
-        start_dir = "%d/%02d/%02d/" % (start.year, start.month ,start.day)
-        end_dir = "%d/%02d/%02d/" % (end.year, end.month, end.day)
-        files_list = []
-
-        # 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
-        # drop everything except the time the time
-        before_time_index = 20
-        after_time_index = 35
-        for dir_key in dir_key_list:
-            for file in self.bucket.list("%s/" % dir_key, "/"):
-                file_name = file.name 
-
-                if not file_name.endswith('gz'):
-                    continue
-
-                if file_name.startswith(start_dir):
-                    file_datetime = datetime.datetime.strptime(
-                            file_name[before_time_index:after_time_index],
-                            "%Y%m%d_%H%M%S")
-                    if file_datetime <= start:
-                        continue
-
-                if file_name.startswith(end_dir):
-                    file_datetime = datetime.datetime.strptime(
-                            file_name[before_time_index:after_time_index],
-                            "%Y%m%d_%H%M%S")
-                    if file_datetime >= end:
-                        continue
-
-                files_list.append(file_name)
-        return files_list
+        return dir_key_list
 
     def _calculateRadiusAtHeight(self, height, station_elevation):
         """This function calculates the radius at the specified height above sealevel.
@@ -546,6 +1250,74 @@ class S3NEXRADHelper:
         return ground_distance
 
 
+    def _calculateRadiiAtHeights(self, heights, station_elevations, above_ground=False):
+        """Vectorized version of _calculateRadiusAtHeight for every pair of station and
+        height. The triangles are solved directly with the law of sines and cosines.
+
+        heights: numpy array of heights in meters
+        station_elevations: numpy array of radar site heights above sea level in meters
+        above_ground: Boolean of if heights are above each radar site instead of above
+            sea level
+
+        returns: numpy array with the shape (len(station_elevations), len(heights)) of
+            ground distance radius of radar in meters or NaN if height is not available
+        """
+        heights = numpy.asarray(heights, dtype=float)[numpy.newaxis, :]
+        station_elevations = numpy.asarray(station_elevations, dtype=float)[:, numpy.newaxis]
+        if above_ground:
+            heights = heights + station_elevations
+
+        unavailable = ((heights > 90000) | (station_elevations > 6267) |
+                (station_elevations >= heights))
+        # keep the math defined for unavailable pairs, they are dropped at the end
+        heights = numpy.where(unavailable, station_elevations + 1000, heights)
+
+        height_km = heights/1000.0 - station_elevations/1000
+        localized_radius = EARTH_RADIUS_KM + station_elevations/1000
+        height_of_beam_end = localized_radius + height_km
+
+        def solveAtAngle(beam_angle):
+            # side a is the localized radius, b the beam end radius and B the angle at the
+            # radar site opposite b, returns the beam length c and earth center angle C
+            radar_site_angle = math.radians(90) + beam_angle
+            beam_point_angle = numpy.arcsin(localized_radius * math.sin(radar_site_angle) /
+                    height_of_beam_end)
+            earth_center_angle = math.pi - radar_site_angle - beam_point_angle
+            beam_distance = height_of_beam_end * numpy.sin(earth_center_angle) / math.sin(radar_site_angle)
+            return beam_distance, earth_center_angle
+
+        beam_distance, earth_center_angle = solveAtAngle(WSR88D_LOW_ANGLE)
+
+        # if our beam_distance is too high then check the highest beam
+        too_far = beam_distance > WSR88D_BEAM_DISTANCE
+        high_beam_distance, high_earth_center_angle = solveAtAngle(WSR88D_HIGH_ANGLE)
+        unavailable |= too_far & (high_beam_distance > WSR88D_BEAM_DISTANCE)
+
+        # solve for this height at max beam_distance to get the ground distance
+        max_beam_cos = ((localized_radius**2 + height_of_beam_end**2 - WSR88D_BEAM_DISTANCE**2) /
+                (2 * localized_radius * height_of_beam_end))
+        max_beam_earth_center_angle = numpy.arccos(numpy.clip(max_beam_cos, -1, 1))
+        earth_center_angle = numpy.where(too_far, max_beam_earth_center_angle, earth_center_angle)
+
+        ground_distance = earth_center_angle * localized_radius * 1000
+
+        return numpy.where(unavailable, numpy.nan, ground_distance)
+
+    def _getWRFDomainBounds(self, dx, dy, e_sn, e_we, ref_lat, ref_lon):
+        """Convert a WRF domain to a lat/lon domain
+
+        dx, dy, e_sn, e_we, ref_lat, ref_lon are equivalent to the namelist.wps variables
+        from the WRF Preprocessing System (WPS)
+
+        returns: tuple of (maxlat, maxlon, minlat, minlon)
+        """
+        center_east, center_north, zone_number, zone_letter = utm.from_latlon(ref_lat, ref_lon)
+        maxlat, maxlon = utm.to_latlon(center_east + (e_we/2.0*dx), center_north + (e_sn/2.0*dy),
+                                       zone_number, zone_letter, strict=False)
+        minlat, minlon = utm.to_latlon(center_east - (e_we/2.0*dx), center_north - (e_sn/2.0*dy),
+                                       zone_number, zone_letter, strict=False)
+        return (maxlat, maxlon, minlat, minlon)
+
     def _isStationInDomainCorner(self, corner_lat, corner_lon, station_lat, station_lon,
             radius):
         """Take the relevant domain distance as the radius for a circle around the point
@@ -609,13 +1381,16 @@ class S3NEXRADHelper:
         self.threads.append(proc)
         self.thread_count += 1
 
-    def _waitForThreadPool(self, thread_max=None):
+    def _waitForThreadPool(self, thread_max=None, result_callback=None):
         if thread_max is None:
             thread_limit = self.thread_max - 1
         else:
             thread_limit = thread_max
         count = 0
+        self._collectResults(result_callback)
         while len(self.threads) > thread_limit:
+            # workers can not exit until their results are read off the queue
+            self._collectResults(result_callback)
             time.sleep(.1)
             if count > len(self.threads) - 1:
                 count = 0
@@ -625,24 +1400,420 @@ class S3NEXRADHelper:
             else: 
                 count += 1
 
-def _downloadFile(key, file_path, verbose):
-    s3conn = boto.connect_s3(anon=True)
-    bucket = s3conn.get_bucket("noaa-nexrad-level2")
+    def _reportDownloads(self, results):
+        """Summarize download results, printing a summary if anything went wrong
+
+        results: list of (key, file_path, status, retries) tuples from the workers
+
+        returns: dictionary with the keys downloaded, redownloaded, failed and missing,
+            see downloadNEXRADFiles
+        """
+        report = {'downloaded': 0, 'redownloaded': 0, 'failed': [], 'missing': []}
+        for key, file_path, status, retries in results:
+            if status == 'downloaded':
+                report['downloaded'] += 1
+                if retries:
+                    report['redownloaded'] += 1
+            else:
+                report[status].append(key)
+
+        if report['failed'] or report['missing'] or (self.verbose and report['redownloaded']):
+            print "%d files downloaded, %d needed to be downloaded again, %d failed, %d missing" % (
+                    report['downloaded'], report['redownloaded'], len(report['failed']),
+                    len(report['missing']))
+
+        return report
+
+    def _collectResults(self, result_callback=None):
+        """Move any download results reported by workers into self.download_results
+
+        result_callback: optional function called as result_callback(key, file_path,
+            status, retries) for each result as it is collected
+        """
+        while True:
+            try:
+                result = self.result_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.download_results.append(result)
+            if result_callback is not None:
+                result_callback(*result)
+
+def _downloadFile(key, file_path, verbose, result_queue=None):
+    """Download a key to file_path in a worker process, see _downloadKey
+
+    key: key in the nexrad bucket to download
+    file_path: path to download the file to
+    verbose: Boolean of if we should print non-error information
+    result_queue: optional queue to put the (key, file_path, status, retries) tuple on
+    """
+    try:
+        s3conn = boto.connect_s3(anon=True)
+        bucket = s3conn.get_bucket("noaa-nexrad-level2")
+        result = _downloadKey(bucket, key, file_path, verbose)
+    except Exception:
+        print "Unable to download %s\n%s" % (key, traceback.format_exc().rstrip())
+        result = (key, file_path, 'failed', 0)
+    if result_queue is not None:
+        result_queue.put(result)
+
+def _downloadKey(bucket, key, file_path, verbose):
+    """Download a key to file_path, verifying it against S3 as it is streamed and
+    retrying up to DOWNLOAD_RETRIES times. The file is written under a temporary name
+    and only moved to file_path once verified, so a killed worker never leaves a
+    truncated file behind.
+
+    bucket: boto bucket object to download from
+    key: key in the nexrad bucket to download
+    file_path: path to download the file to
+    verbose: Boolean of if we should print non-error information
+
+    returns: tuple of (key, file_path, status, retries), status is one of
+        'downloaded', 'failed' or 'missing'
+    """
     keyobj = bucket.get_key(key)
     if keyobj is None:
-        if self.verbose: print "Unable to find file %s, skipping" % key
-        return
+        print "Unable to find file %s, skipping" % key
+        return (key, file_path, 'missing', 0)
+
+    # multipart uploads have an ETag of "<md5 of part md5s>-<part count>" which is
+    # not the MD5 of the file, so only the size can be checked for them
+    etag = keyobj.etag.strip('"')
+    expected_md5 = None
+    if '-' not in etag:
+        expected_md5 = etag
+
+    part_path = "%s.part" % file_path
+    status = 'failed'
+    retries = 0
+    while True:
+        if _streamKeyToFile(keyobj, part_path, keyobj.size, expected_md5):
+            os.rename(part_path, file_path)
+            status = 'downloaded'
+            break
+
+        if retries >= DOWNLOAD_RETRIES:
+            print "%s failed verification after %d attempts" % (key, retries + 1)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            break
+
+        retries += 1
+        if verbose:
+            print "%s failed verification, downloading again" % key
+
+    if verbose and status == 'downloaded':
+        print "%s downloaded" % file_path
+
+    return (key, file_path, status, retries)
+
+def _streamKeyToFile(keyobj, file_path, expected_size, expected_md5):
+    """Stream a key to a file, computing the MD5 and size of the bytes as they are
+    written so the file does not need to be read again to verify it.
 
-    dfile = open(file_path, 'w')
+    keyobj: boto key object to download
+    file_path: path to write the file to
+    expected_size: size in bytes the file should be
+    expected_md5: hex MD5 the file should have, None to only check the size
+
+    returns: Boolean of if the file matched
+    """
+    md5 = hashlib.md5()
+    size = 0
+    dfile = open(file_path, 'wb')
     try:
-        keyobj.get_file(dfile)
+        keyobj.open_read()
+        while True:
+            data = keyobj.read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            md5.update(data)
+            size += len(data)
+            dfile.write(data)
+    except (IOError, httplib.HTTPException, boto.exception.S3ResponseError):
+        return False
     finally:
+        keyobj.close(fast=True)
         dfile.close()
 
-    if verbose:
-        print "%s downloaded" % file_path
+    if size != expected_size:
+        return False
+
+    if expected_md5 is not None and md5.hexdigest() != expected_md5:
+        return False
 
+    return True
 
+def _processFile(processor, file_path, pass_buffer, result_queue):
+    """Run processor on a downloaded file in a worker process, catching any exception
+    so one bad file does not stop the others
+
+    processor: function to run, see downloadAndProcessNEXRADFiles
+    file_path: path of the downloaded file
+    pass_buffer: Boolean of if processor should also get the contents of the file
+    result_queue: queue to put a (file_path, result, error) tuple on where error is
+        None or the formatted traceback of the exception
+    """
+    try:
+        if pass_buffer:
+            dfile = open(file_path, 'rb')
+            try:
+                data = dfile.read()
+            finally:
+                dfile.close()
+            result = (file_path, processor(file_path, data), None)
+        else:
+            result = (file_path, processor(file_path), None)
+    except Exception:
+        result = (file_path, None, traceback.format_exc())
+    result_queue.put(result)
+
+class _TimeSliceTracker:
+
+    def __init__(self, s3keys, slice_minutes, slice_callback, stations=None):
+        """Tracks downloads by time slice and calls slice_callback once every selected
+        station has a downloaded file for a slice
+
+        s3keys: list of keys in the nexrad bucket that will be downloaded
+        slice_minutes: length in minutes of a time slice
+        slice_callback: function called as slice_callback(slice_start, file_paths,
+            missing_stations)
+        stations: list of the selected station ids, defaults to the stations in s3keys
+        """
+        self.slice_minutes = slice_minutes
+        self.slice_callback = slice_callback
+        if stations is None:
+            stations = [_keyStation(key) for key in s3keys]
+        self.stations = set(stations)
+        # slice start -> stations with a downloaded file, for slices not reported yet
+        self.slice_stations = {}
+        # slice start -> downloaded file paths, for slices not reported yet
+        self.slice_paths = {}
+        for key in s3keys:
+            slice_start = _keySliceStart(key, self.slice_minutes)
+            self.slice_stations.setdefault(slice_start, set())
+            self.slice_paths.setdefault(slice_start, [])
+
+    def addResult(self, key, file_path, status, retries):
+        """Record a download result, calling slice_callback if it completes a slice
+
+        key, file_path, status, retries: a download result from _downloadKey
+        """
+        if status != 'downloaded':
+            return
+        slice_start = _keySliceStart(key, self.slice_minutes)
+        # files that finish after their slice was reported are left out of it
+        if slice_start not in self.slice_stations:
+            return
+        self.slice_paths[slice_start].append(file_path)
+        self.slice_stations[slice_start].add(_keyStation(key))
+        if self.slice_stations[slice_start] >= self.stations:
+            del self.slice_stations[slice_start]
+            self.slice_callback(slice_start, self.slice_paths.pop(slice_start), [])
+
+    def finish(self):
+        """Call slice_callback for every slice that never completed, in time order, with
+        the stations that do not have a file for it
+        """
+        for slice_start in sorted(self.slice_stations):
+            missing_stations = sorted(self.stations - self.slice_stations.pop(slice_start))
+            self.slice_callback(slice_start, self.slice_paths.pop(slice_start), missing_stations)
+
+def _keySliceStart(key, slice_minutes):
+    """Get the start of the time slice a key falls in
+
+    key: key in the nexrad bucket ex. 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+    slice_minutes: length in minutes of a time slice
+
+    returns: datetime.datetime object of the start of the slice
+    """
+    seconds = (_keyDatetime(key) - EPOCH).total_seconds()
+    return EPOCH + datetime.timedelta(seconds=seconds - seconds % (slice_minutes * 60))
+
+def _keyDatetime(key):
+    """Get the scan time of a key
+
+    key: key in the nexrad bucket ex. 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+
+    returns: datetime.datetime object of the scan time
+    """
+    # 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+    # drop everything except the time the time
+    return datetime.datetime.strptime(key[20:35], "%Y%m%d_%H%M%S")
+
+def _keyStation(key):
+    """Get the station id of a key
+
+    key: key in the nexrad bucket ex. 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+
+    returns: station id as a string ex. "KSGF"
+    """
+    return key.split('/')[3]
+
+def _scheduleKeysByTime(s3keys, latest_first=False, slice_minutes=None):
+    """Order keys by scan time across all stations. Stations take turns when their
+    next scans have the same time. Stations that scan more often still get ahead of
+    the others unless slice_minutes is given, then each time slice starts with one
+    key from every station in it before the rest of the keys for that slice.
+
+    s3keys: list of keys in the nexrad bucket
+    latest_first: Boolean of if the latest scans should come first
+    slice_minutes: optional length in minutes of the time slices to schedule by
+
+    returns: list of keys in download order
+    """
+    if slice_minutes is not None:
+        slice_keys = {}
+        for key in s3keys:
+            slice_keys.setdefault(_keySliceStart(key, slice_minutes), []).append(key)
+
+        scheduled_keys = []
+        for slice_start in sorted(slice_keys, reverse=latest_first):
+            # first key of each station in the slice, then the extra scans
+            first_keys = []
+            extra_keys = []
+            seen_stations = set()
+            for key in _scheduleKeysByTime(slice_keys[slice_start], latest_first):
+                if _keyStation(key) in seen_stations:
+                    extra_keys.append(key)
+                else:
+                    seen_stations.add(_keyStation(key))
+                    first_keys.append(key)
+            scheduled_keys.extend(first_keys)
+            scheduled_keys.extend(extra_keys)
+        return scheduled_keys
+
+    station_keys = {}
+    for key in s3keys:
+        station_keys.setdefault(_keyStation(key), []).append(key)
+
+    def sortTime(key):
+        seconds = (_keyDatetime(key) - EPOCH).total_seconds()
+        if latest_first:
+            return -seconds
+        return seconds
+
+    # (time of next scan, turn, station), the turn breaks ties in favor of the station
+    # that was served longest ago
+    heap = []
+    turn = 0
+    for station_id in sorted(station_keys):
+        station_keys[station_id].sort(key=sortTime, reverse=True)
+        heap.append((sortTime(station_keys[station_id][-1]), turn, station_id))
+        turn += 1
+    heapq.heapify(heap)
+
+    scheduled_keys = []
+    while heap:
+        next_time, station_turn, station_id = heapq.heappop(heap)
+        scheduled_keys.append(station_keys[station_id].pop())
+        if station_keys[station_id]:
+            heapq.heappush(heap, (sortTime(station_keys[station_id][-1]), turn, station_id))
+            turn += 1
+    return scheduled_keys
+
+def _between(values, lower, upper):
+    """Elementwise check of lower <= values <= upper for numpy arrays
+
+    returns: numpy boolean array
+    """
+    return (values >= lower) & (values <= upper)
+
+def _dirKeyForDay(day, station_id):
+    """Build the bucket prefix for one day of one station
+
+    day: datetime.datetime object of the day
+    station_id: station id as a string ex. "KSGF"
+
+    returns: prefix ex. "2015/05/06/KSGF"
+    """
+    return "%d/%02d/%02d/%s" % (day.year, day.month, day.day, station_id)
+
+def _checkShard(shard):
+    """Check that a shard is a valid (shard_index, shard_count) tuple
+
+    shard: tuple of (shard_index, shard_count)
+
+    returns: tuple of (shard_index, shard_count)
+    """
+    try:
+        shard_index, shard_count = shard
+    except (TypeError, ValueError):
+        raise ValueError("shard must be a tuple of (shard_index, shard_count), got %r" % (shard,))
+    if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+        raise ValueError("shard must have 0 <= shard_index < shard_count, got %r" % (shard,))
+    return shard_index, shard_count
+
+def _partitionDirKeys(dir_key_list, shard_count):
+    """Deterministically split (day, station) prefixes into shards. The stations of
+    each day are dealt out round robin so each shard gets an even share of every
+    day, starting one shard later each day so a station's days are spread over all
+    shards instead of always landing on the same one. The result does not depend on
+    input order.
+
+    dir_key_list: list of prefixes ex. ["2015/05/06/KSGF"]
+    shard_count: number of shards to split into
+
+    returns: list of shard_count lists of prefixes
+    """
+    dir_key_list = sorted(set(dir_key_list))
+    stations = sorted(set([dir_key[11:] for dir_key in dir_key_list]))
+    station_offsets = dict([(station_id, i) for i, station_id in enumerate(stations)])
+
+    shards = [[] for i in range(shard_count)]
+    for dir_key in dir_key_list:
+        day = datetime.datetime.strptime(dir_key[:10], "%Y/%m/%d").toordinal()
+        shards[(day + station_offsets[dir_key[11:]]) % shard_count].append(dir_key)
+    return shards
+
+def _partitionKeys(s3keys, shard_count):
+    """Deterministically split keys into shards by a hash of each key. The shard of a
+    key only depends on the key itself, so nodes with different or slightly out of
+    date key lists, ex. loaded from a manifest or listed a few seconds apart, never
+    disagree on where a key belongs. With many keys of similar size this also
+    balances the bytes per shard.
+
+    s3keys: list of keys in the nexrad bucket
+    shard_count: number of shards to split into
+
+    returns: list of shard_count lists of keys in the order of s3keys
+    """
+    shards = [[] for i in range(shard_count)]
+    for key in s3keys:
+        shards[int(hashlib.md5(key).hexdigest(), 16) % shard_count].append(key)
+    return shards
+
+def writeManifest(manifest_path, s3keys):
+    """Write a list of keys to a manifest file, one key per line
+
+    manifest_path: path of the manifest file to write
+    s3keys: list of keys in the nexrad bucket
+    """
+    manifest = open(manifest_path, 'w')
+    try:
+        for key in s3keys:
+            manifest.write("%s\n" % key)
+    finally:
+        manifest.close()
+
+def mergeManifests(manifest_paths):
+    """Merge per-shard manifest files into one complete list of keys
+
+    manifest_paths: list of paths to manifest files written by writeManifest
+
+    returns: sorted list of unique keys found in all manifests
+    """
+    s3keys = set()
+    for manifest_path in manifest_paths:
+        manifest = open(manifest_path)
+        try:
+            for line in manifest:
+                line = line.strip()
+                if line:
+                    s3keys.add(line)
+        finally:
+            manifest.close()
+    return sorted(s3keys)
 
 
 def main():
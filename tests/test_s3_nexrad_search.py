@@ -0,0 +1,310 @@
+import datetime
+import math
+import unittest
+
+import numpy
+
+from s3_nexrad_search.s3_nexrad_search import S3NEXRADHelper, STATION_INDEX, \
+        _TimeSliceTracker, _checkShard, _partitionDirKeys, _partitionKeys, \
+        _scheduleKeysByTime
+
+
+class OfflineS3NEXRADHelper(S3NEXRADHelper):
+
+    def __init__(self, bucket=None):
+        """Skips connecting to S3, listing goes to bucket, a StubBucket"""
+        self.verbose = False
+        self.thread_max = 1
+        self.bucket = bucket
+        self.last_seen_keys = {}
+
+
+class StubKey(object):
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class StubBucket(object):
+
+    def __init__(self, key_sizes):
+        """key_sizes: dictionary of key name to size in bytes"""
+        self.key_sizes = key_sizes
+        self.list_prefixes = []
+
+    def list(self, prefix, delimiter, marker=''):
+        self.list_prefixes.append(prefix)
+        return [StubKey(name, self.key_sizes[name]) for name in sorted(self.key_sizes)
+                if name.startswith(prefix) and name > marker]
+
+
+class TestCalculateRadiiAtHeights(unittest.TestCase):
+
+    def setUp(self):
+        self.nexrad = OfflineS3NEXRADHelper()
+        self.station_elevations = numpy.array(
+                [station['station_elevation'] for station in STATION_INDEX])
+
+    def test_matches_calculate_radius_at_height(self):
+        heights = numpy.arange(0, 95000, 500.0)
+        radii = self.nexrad._calculateRadiiAtHeights(heights, self.station_elevations)
+
+        self.assertEqual(radii.shape, (len(STATION_INDEX), len(heights)))
+        for i, station_elevation in enumerate(self.station_elevations):
+            for j, height in enumerate(heights):
+                radius = self.nexrad._calculateRadiusAtHeight(height, station_elevation)
+                if radius is None:
+                    self.assertTrue(math.isnan(radii[i, j]),
+                            "station %d height %d should be unavailable" % (i, height))
+                else:
+                    self.assertAlmostEqual(radii[i, j], radius, places=3)
+
+    def test_above_ground(self):
+        heights = numpy.arange(1000, 20500, 500.0)
+        radii = self.nexrad._calculateRadiiAtHeights(heights, self.station_elevations,
+                above_ground=True)
+
+        for i, station_elevation in enumerate(self.station_elevations):
+            expected = self.nexrad._calculateRadiiAtHeights(heights + station_elevation,
+                    [station_elevation])[0]
+            numpy.testing.assert_array_equal(radii[i], expected)
+
+
+def makeKey(station_id, scan_time):
+    return "%s/%s/%s%s_V06" % (scan_time.strftime("%Y/%m/%d"), station_id, station_id,
+            scan_time.strftime("%Y%m%d_%H%M%S"))
+
+
+class TestScheduleKeysByTime(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime.datetime(2015, 5, 5, 15, 0)
+        minutes = datetime.timedelta(minutes=1)
+        # KIND scans every 2 minutes, KILN every 5 minutes
+        self.kind_keys = [makeKey('KIND', start + i * minutes) for i in range(0, 20, 2)]
+        self.kiln_keys = [makeKey('KILN', start + i * minutes) for i in range(0, 20, 5)]
+        self.s3keys = self.kiln_keys + self.kind_keys
+
+    def test_time_order(self):
+        scheduled_keys = _scheduleKeysByTime(self.s3keys)
+
+        self.assertEqual(sorted(scheduled_keys), sorted(self.s3keys))
+        # stations with scans at the same time take turns
+        self.assertEqual(scheduled_keys[:2], [self.kiln_keys[0], self.kind_keys[0]])
+        scan_times = [key.split('/')[-1][4:19] for key in scheduled_keys]
+        self.assertEqual(scan_times, sorted(scan_times))
+
+    def test_latest_first(self):
+        scheduled_keys = _scheduleKeysByTime(self.s3keys, latest_first=True)
+
+        self.assertEqual(sorted(scheduled_keys), sorted(self.s3keys))
+        self.assertEqual(scheduled_keys[0], self.kind_keys[-1])
+        scan_times = [key.split('/')[-1][4:19] for key in scheduled_keys]
+        self.assertEqual(scan_times, sorted(scan_times, reverse=True))
+
+    def test_slices_start_with_every_station(self):
+        scheduled_keys = _scheduleKeysByTime(self.s3keys, slice_minutes=10)
+
+        self.assertEqual(sorted(scheduled_keys), sorted(self.s3keys))
+        self.assertEqual(scheduled_keys[:2], [self.kiln_keys[0], self.kind_keys[0]])
+        # the second slice starts at 15:10 with KIND at 15:10 and KILN at 15:10
+        second_slice = scheduled_keys[7:9]
+        self.assertEqual(sorted(second_slice), sorted([self.kiln_keys[2], self.kind_keys[5]]))
+
+    def test_slices_latest_first(self):
+        scheduled_keys = _scheduleKeysByTime(self.s3keys, latest_first=True, slice_minutes=10)
+
+        self.assertEqual(sorted(scheduled_keys), sorted(self.s3keys))
+        # the latest slice comes first with the latest scan of each station
+        self.assertEqual(scheduled_keys[:2], [self.kind_keys[-1], self.kiln_keys[-1]])
+
+
+class TestTimeSliceTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.slices = []
+        start = datetime.datetime(2015, 5, 5, 15, 0)
+        self.first_slice = start
+        self.second_slice = start + datetime.timedelta(minutes=10)
+        self.s3keys = [makeKey('KIND', start), makeKey('KILN', start),
+                makeKey('KIND', self.second_slice), makeKey('KILN', self.second_slice)]
+        self.tracker = _TimeSliceTracker(self.s3keys, 10, self.sliceCallback)
+
+    def sliceCallback(self, slice_start, file_paths, missing_stations):
+        self.slices.append((slice_start, file_paths, missing_stations))
+
+    def test_complete_slice(self):
+        self.tracker.addResult(self.s3keys[0], 'a', 'downloaded', 0)
+        self.assertEqual(self.slices, [])
+        self.tracker.addResult(self.s3keys[1], 'b', 'downloaded', 0)
+        self.assertEqual(self.slices, [(self.first_slice, ['a', 'b'], [])])
+
+        self.tracker.finish()
+        self.assertEqual(self.slices[1], (self.second_slice, [], ['KILN', 'KIND']))
+
+    def test_incomplete_slice(self):
+        self.tracker.addResult(self.s3keys[2], 'c', 'downloaded', 0)
+        self.tracker.addResult(self.s3keys[3], 'd', 'failed', 3)
+        self.tracker.addResult(self.s3keys[0], 'a', 'downloaded', 0)
+        self.assertEqual(self.slices, [])
+
+        self.tracker.finish()
+        self.assertEqual(self.slices, [(self.first_slice, ['a'], ['KILN']),
+                (self.second_slice, ['c'], ['KILN'])])
+
+    def test_selected_stations(self):
+        tracker = _TimeSliceTracker(self.s3keys, 10, self.sliceCallback, ['KIND'])
+        tracker.addResult(self.s3keys[0], 'a', 'downloaded', 0)
+        self.assertEqual(self.slices, [(self.first_slice, ['a'], [])])
+
+        # later files for a reported slice are not reported again
+        tracker.addResult(self.s3keys[1], 'b', 'downloaded', 0)
+        tracker.finish()
+        self.assertEqual(self.slices[1:], [(self.second_slice, [], ['KIND'])])
+
+
+class TestPartition(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_keys = ["2015/05/%02d/%s" % (day, station_id)
+                for day in range(1, 9) for station_id in ['KILN', 'KIND']]
+
+    def test_dir_keys_cover_input(self):
+        for shard_count in range(1, 6):
+            shards = _partitionDirKeys(self.dir_keys, shard_count)
+            self.assertEqual(len(shards), shard_count)
+            self.assertEqual(sorted(sum(shards, [])), sorted(self.dir_keys))
+            # every shard gets an even share of each day
+            for day in range(1, 9):
+                sizes = [len([dir_key for dir_key in shard
+                        if dir_key.startswith("2015/05/%02d/" % day)]) for shard in shards]
+                self.assertTrue(max(sizes) - min(sizes) <= 1, sizes)
+
+    def test_dir_keys_deterministic(self):
+        shards = _partitionDirKeys(self.dir_keys, 4)
+        self.assertEqual(_partitionDirKeys(list(reversed(self.dir_keys)), 4), shards)
+        self.assertEqual(_partitionDirKeys(self.dir_keys + self.dir_keys[:3], 4), shards)
+
+    def test_dir_keys_rotate_stations(self):
+        # 2 stations on 4 shards, each station should reach every shard
+        shards = _partitionDirKeys(self.dir_keys, 4)
+        for station_id in ['KILN', 'KIND']:
+            station_shards = [i for i, shard in enumerate(shards)
+                    for dir_key in shard if dir_key.endswith(station_id)]
+            self.assertEqual(sorted(set(station_shards)), [0, 1, 2, 3])
+
+    def test_keys_cover_input(self):
+        start = datetime.datetime(2015, 5, 5, 15, 0)
+        s3keys = [makeKey(station_id, start + datetime.timedelta(minutes=i))
+                for i in range(50) for station_id in ['KILN', 'KIND']]
+        shards = _partitionKeys(s3keys, 3)
+        self.assertEqual(sorted(sum(shards, [])), sorted(s3keys))
+        # the shard of a key does not depend on the other keys
+        for i, shard in enumerate(_partitionKeys(s3keys[::-3], 3)):
+            for key in shard:
+                self.assertTrue(key in shards[i])
+
+    def test_check_shard(self):
+        self.assertEqual(_checkShard((3, 4)), (3, 4))
+        for shard in [(4, 4), (0, 0), (-1, 2), 4, None]:
+            self.assertRaises(ValueError, _checkShard, shard)
+
+
+class TestEstimateNEXRADDownload(unittest.TestCase):
+
+    def setUp(self):
+        # three scans a day, KIND files are 100 bytes and KILN files 200 bytes
+        key_sizes = {}
+        for day in range(1, 12):
+            for hour in [0, 8, 16]:
+                scan_time = datetime.datetime(2015, 5, day, hour)
+                key_sizes[makeKey('KIND', scan_time)] = 100
+                key_sizes[makeKey('KILN', scan_time)] = 200
+                key_sizes[makeKey('KIND', scan_time) + '_MDM'] = 1
+        self.nexrad = OfflineS3NEXRADHelper(StubBucket(key_sizes))
+        # the partial first day has one scan and the last day two
+        self.start = datetime.datetime(2015, 5, 1, 12)
+        self.end = datetime.datetime(2015, 5, 11, 12)
+
+    def test_exact(self):
+        report = self.nexrad.estimateNEXRADDownload(self.start, self.end, ['KIND', 'KILN'])
+
+        self.assertFalse(report['sampled'])
+        self.assertEqual(report['list_requests'], 22)
+        self.assertEqual(report['listed_prefixes'], 22)
+        self.assertEqual(report['file_count'], 60)
+        self.assertEqual(report['total_bytes'], 30 * 100 + 30 * 200)
+        self.assertEqual(report['stations']['KIND'], {'total_bytes': 3000,
+                'file_count': 30, 'prefixes': 11, 'extrapolated': False})
+
+    def test_sampled(self):
+        report = self.nexrad.estimateNEXRADDownload(self.start, self.end, ['KIND', 'KILN'],
+                sample_size=4)
+
+        self.assertTrue(report['sampled'])
+        self.assertEqual(report['list_requests'], 22)
+        # the first and last day of both stations plus the sample
+        self.assertEqual(report['listed_prefixes'], 8)
+        self.assertEqual(report['file_count'], 60)
+        self.assertEqual(len(self.nexrad.bucket.list_prefixes), 8)
+
+    def test_extrapolated(self):
+        report = self.nexrad.estimateNEXRADDownload(self.start, self.end, ['KIND', 'KILN'],
+                sample_size=1)
+
+        extrapolated = [station_id for station_id, station in report['stations'].items()
+                if station['extrapolated']]
+        self.assertEqual(len(extrapolated), 1)
+        sampled_station = report['stations'][({'KIND', 'KILN'} - set(extrapolated)).pop()]
+        # the sampled station is exact, the other uses its days
+        sampled_bytes = sampled_station['total_bytes'] // 30
+        other_bytes = 300 - sampled_bytes
+        self.assertEqual(report['stations'][extrapolated[0]]['total_bytes'],
+                3 * other_bytes + 27 * sampled_bytes)
+        self.assertEqual(report['file_count'], 60)
+
+    def test_sample_size(self):
+        self.assertRaises(ValueError, self.nexrad.estimateNEXRADDownload,
+                self.start, self.end, ['KIND'], sample_size=0)
+
+
+class TestPollStation(unittest.TestCase):
+
+    def setUp(self):
+        today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday = today - datetime.timedelta(days=1)
+        self.seen_key = makeKey('KIND', yesterday + datetime.timedelta(hours=1))
+        self.yesterday_key = makeKey('KIND', yesterday + datetime.timedelta(hours=23))
+        self.today_key = makeKey('KIND', today)
+        self.later_key = makeKey('KIND', today + datetime.timedelta(seconds=1))
+        self.bucket = StubBucket(dict([(key, 100) for key in [self.seen_key,
+                self.yesterday_key, self.yesterday_key + '_MDM', self.today_key]]))
+        self.nexrad = OfflineS3NEXRADHelper(self.bucket)
+        self.nexrad.last_seen_keys['KIND'] = self.seen_key
+
+    def test_day_rollover(self):
+        new_keys = self.nexrad._pollStation('KIND')
+
+        self.assertEqual(new_keys, [self.yesterday_key, self.today_key])
+        self.assertEqual(len(self.bucket.list_prefixes), 2)
+        self.assertEqual(self.nexrad.last_seen_keys['KIND'], self.today_key)
+
+        # later polls only list today and only return new keys
+        self.assertEqual(self.nexrad._pollStation('KIND'), [])
+        self.bucket.key_sizes[self.later_key] = 100
+        self.assertEqual(self.nexrad._pollStation('KIND'), [self.later_key])
+        self.assertEqual(self.bucket.list_prefixes[2:], [self.today_key[:16]] * 2)
+
+    def test_no_files_today(self):
+        del self.bucket.key_sizes[self.today_key]
+
+        self.assertEqual(self.nexrad._pollStation('KIND'), [self.yesterday_key])
+        # the marker moves to today's prefix so yesterday is not listed again
+        self.assertEqual(self.nexrad.last_seen_keys['KIND'], self.today_key[:16])
+        self.nexrad._pollStation('KIND')
+        self.assertEqual(self.bucket.list_prefixes[2:], [self.today_key[:16]])
+
+
+if __name__ == '__main__':
+    unittest.main()